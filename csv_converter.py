@@ -39,13 +39,20 @@
 #                                Import Modules                                #
 ################################################################################
 
-from pathlib import Path
-from os.path import exists
+from contextlib import closing
+from itertools import chain
+from operator import itemgetter
+from time import localtime, strftime
 import argparse
+import atexit
+import codecs
 import csv
-import datetime
+import gzip
+import io
 import json
 import logging
+import os
+import sys
 
 ################################################################################
 #                                  Variables                                   #
@@ -59,8 +66,9 @@ Requires:
     Python 3.6+
 """
 
-# These are the headers in the CSV for the source file.
-SOURCE_HEADERS = {
+# These are the headers in the CSV for the source file. Source rows are loaded
+#   as tuples with the fields in this order.
+SOURCE_HEADERS = [
     "No",
     "Customer ID",
     "Company Name",
@@ -69,25 +77,44 @@ SOURCE_HEADERS = {
     "Current Amount",
     "YTD Volume",
     "YTD Amount",
-}
+]
 
-# These are the headers in the CSV for the mapping file.
-MAPPING_HEADERS = {
+# These are the headers in the CSV for the mapping file. This is a list so new
+#   rows appended to the mapping file keep a stable column order.
+MAPPING_HEADERS = [
     "Customer ID",
     "Company Name",
     "Account Number",
-}
+]
+
+# Number of new accounts to collect before they are written to the mapping file.
+MAPPING_FLUSH_INTERVAL = 64
 
 # This is the header name used to match an account from the two systems.
 ACCOUNT_KEY = "Customer ID"
 
+# Fields whose values repeat across lines and files. These are interned so each
+#   distinct value is only stored once.
+INTERNED_FIELDS = {
+    "Customer ID",
+    "Company Name",
+}
+
 # Contains the source field name and what it needs to be renamed to.
 FIELD_NAME_CHANGE = {
     "SOURCE_FIELD_NAME": "DESTINATION_FIELD_NAME",
 }
 
+# The field name changes that apply to a header in the source file.
+ACTIVE_RENAMES = {
+    source_field: dest_field
+    for source_field, dest_field in FIELD_NAME_CHANGE.items()
+    if source_field in SOURCE_HEADERS
+}
+
 # These are the headers in the CSV for the destination file (to the billing software).
-BILLING_HEADERS = {
+#   Converted rows are written with the fields in this order.
+BILLING_HEADERS = [
     "No",
     "Customer ID",
     "Company Name",
@@ -97,87 +124,183 @@ BILLING_HEADERS = {
     "Current Amount",
     "YTD Volume",
     "YTD Amount",
-}
+]
 DEFAULT_SOURCE_CSV_FILENAME = "accounting.csv"
 DEFAULT_MAPPING_CSV_FILENAME = "account_mapping.csv"
 DEFAULT_DEST_CSV_FILENAME_PREFIX = "billing_"
 DEFAULT_DEST_CSV_FILENAME = f"{DEFAULT_DEST_CSV_FILENAME_PREFIX}YYYYMMDD_HHMM.csv"
 
+# Buffer size in bytes used when reading and writing CSV files.
+CSV_BUFFER_SIZE = 1 << 20
+
+# CSV files with this suffix are read and written with gzip compression.
+GZIP_SUFFIX = ".gz"
+
+# Suffix added to a CSV file's name while it is being written.
+PARTIAL_SUFFIX = ".part"
+
 LOGGER = logging.getLogger(__name__)
 
 ################################################################################
 #                                  Functions                                   #
 ################################################################################
 
-def convert_formats(accounting_data, mapping_data):
+def convert_formats(accounting_data, mapping_data, mapping_fp):
     """
     This converts the original data and changes it to match the desired format
-    for the destination system.
+    for the destination system. This is a generator, rows are converted as they
+    are read and yielded as tuples in the order of `BILLING_HEADERS`.
+
+    New accounts are appended to the open mapping file `mapping_fp`.
     """
     line_count = 0
 
-    # Iterate over each line in source file.
-    for row in accounting_data:
-        line_count += 1
-        LOGGER.info(f"Converting line {line_count}")
-
-        ## Check if account number is in account mapping file.
-        # If there is not a matching account number: prompt the user, immediately
-        #   add it to the mapping file.
-        if row[ACCOUNT_KEY] not in mapping_data.keys():
-            row['Account Number'] = prompt_user_for_account(row['Customer ID'], row['Company Name'])
-            mapping_data[row[ACCOUNT_KEY]] = {
-                "Customer ID": row['Customer ID'],
-                "Company Name": row['Company Name'],
-                "Account Number": row['Account Number'],
-            }
-            write_csv(DEFAULT_MAPPING_CSV_FILENAME, MAPPING_HEADERS, mapping_data.values())
-        else:
-            row['Account Number'] = mapping_data[row[ACCOUNT_KEY]]['Account Number']
-
-        # Rename source field names to match expected destination field names.
-        for source_field, dest_field in FIELD_NAME_CHANGE.items():
-            if source_field in row.keys():
-                row[dest_field] = row[source_field]
-                del row[source_field]
-
-        # Add any special handling here. Such as splitting fields or other field specific processing.
-
-    return accounting_data
-
-
-def load_csv(filename, headers, load_as_dict=False):
+    # Rename source field names to match expected destination field names. As
+    #   rows are positional only the names need to change, not every row.
+    converted_headers = [ACTIVE_RENAMES.get(field, field) for field in SOURCE_HEADERS]
+    converted_headers.append("Account Number")
+
+    # Positions of the fields needed to convert each row.
+    account_index = SOURCE_HEADERS.index(ACCOUNT_KEY)
+    id_index = SOURCE_HEADERS.index("Customer ID")
+    name_index = SOURCE_HEADERS.index("Company Name")
+    to_billing_order = itemgetter(*[converted_headers.index(field) for field in BILLING_HEADERS])
+
+    # Match the column order of the mapping file, otherwise appended rows would
+    #   not line up with its header. New accounts are then appended in batches,
+    #   rather than rewriting the whole file every time an account is added.
+    mapping_fp.seek(0)
+    mapping_headers = next(split_csv_lines(mapping_fp), None)
+    mapping_end = mapping_fp.seek(0, io.SEEK_END)
+
+    # A file whose last line has no line break needs one before new rows are
+    #   appended, otherwise the first new row is joined to that last line.
+    needs_line_break = False
+    if mapping_headers is not None and mapping_end > 0:
+        mapping_fp.buffer.seek(mapping_end - 1)
+        needs_line_break = mapping_fp.buffer.read(1) not in (b'\r', b'\n')
+        mapping_fp.seek(0, io.SEEK_END)
+
+    mapping_writer = csv.writer(
+        mapping_fp,
+        quoting=csv.QUOTE_ALL,
+        lineterminator='\r\n',
+        delimiter=','
+    )
+    if mapping_headers is None:
+        mapping_headers = MAPPING_HEADERS
+        mapping_writer.writerow(mapping_headers)
+
+    new_mappings = []
+
+    def flush_new_mappings():
+        """
+        Writes any accounts not yet saved to the mapping file.
+        """
+        nonlocal needs_line_break
+        # At exit the caller may already have closed the mapping file.
+        if mapping_fp.closed:
+            return
+        if new_mappings and needs_line_break:
+            mapping_fp.write('\r\n')
+            needs_line_break = False
+        mapping_writer.writerows(new_mappings)
+        mapping_fp.flush()
+        new_mappings.clear()
+
+    # Pending accounts are also written at exit in case the conversion is never
+    #   finished.
+    atexit.register(flush_new_mappings)
+
+    # Bind names used for every row to locals.
+    mapping_get = mapping_data.get
+    log_info = LOGGER.info
+
+    try:
+        # Iterate over each line in source file.
+        for row in accounting_data:
+            line_count += 1
+            log_info("Converting line %d", line_count)
+
+            ## Check if account number is in account mapping file.
+            # If there is not a matching account number: prompt the user, and
+            #   queue it to be added to the mapping file.
+            account_key = row[account_index]
+            account_number = mapping_get(account_key)
+            if account_number is None:
+                account_number = prompt_user_for_account(row[id_index], row[name_index])
+                new_mapping = {
+                    "Customer ID": row[id_index],
+                    "Company Name": row[name_index],
+                    "Account Number": account_number,
+                }
+                mapping_data[account_key] = account_number
+                # Columns not known to this script are left empty.
+                new_mappings.append([new_mapping.get(field, '') for field in mapping_headers])
+                if len(new_mappings) >= MAPPING_FLUSH_INTERVAL:
+                    flush_new_mappings()
+
+            # Add any special handling here. Such as splitting fields or other field specific processing.
+
+            yield to_billing_order(row + (account_number,))
+    finally:
+        atexit.unregister(flush_new_mappings)
+        flush_new_mappings()
+
+
+def load_csv(fp, headers, load_as_dict=False):
     """
-    Loads data from a CSV file. Can load data as an dictionary or as a list of
-    dictionaries.
+    Loads data from an open CSV file. Can load data as a dictionary of account
+    numbers keyed by `ACCOUNT_KEY` or as an iterator of tuples, with the fields
+    in the order of `headers`, which reads the file as it is consumed.
     """
-    line_count = 0
+    if not load_as_dict:
+        return read_csv(fp, headers)
 
-    if load_as_dict:
-        dataset = {}
-    else:
-        dataset = []
-
-    with open(filename, encoding='utf-8-sig') as fp:
-        csv_reader = csv.DictReader(
-            fp,
-            #fieldnames=headers,
-            quoting=csv.QUOTE_ALL,
-            lineterminator='\r\n',
-            delimiter=','
-        )
-
-        for row in csv_reader:
-            line_count += 1
-            if load_as_dict:
-                dataset[row[ACCOUNT_KEY]] = row
-            else:
-                dataset.append(row)
-    LOGGER.info(f"Processed {line_count} lines from {filename}")
+    dataset = {}
+    key_index = headers.index(ACCOUNT_KEY)
+    value_index = headers.index("Account Number")
+    for row in read_csv(fp, headers):
+        dataset[row[key_index]] = row[value_index]
 
     return dataset
 
 
+def open_csv(filename, mode='r'):
+    """
+    Opens an existing CSV file, by default for reading. Files ending in
+    `GZIP_SUFFIX` are decompressed as they are read.
+    """
+    if filename.endswith(GZIP_SUFFIX):
+        opener = gzip.open
+        mode += 't'
+        options = {}
+    else:
+        opener = open
+        options = {'buffering': CSV_BUFFER_SIZE}
+
+    # Only use the slower BOM stripping codec when the file starts with a BOM.
+    #   Anything written to a file with a BOM must come after it, as the codec
+    #   adds a new BOM when writing at the start of the file.
+    with opener(filename, 'rb') as fp:
+        has_bom = fp.read(3) == codecs.BOM_UTF8
+    encoding = 'utf-8-sig' if has_bom else 'utf-8'
+
+    return opener(filename, mode, newline='', encoding=encoding, **options)
+
+
+def open_mapping_csv(filename):
+    """
+    Opens the account mapping file for reading and appending, creating it if it
+    is missing.
+    """
+    try:
+        return open_csv(filename, 'r+')
+    except FileNotFoundError:
+        LOGGER.error(f"Mapping file is missing, creating.")
+        return open(filename, 'w+', newline='', encoding='utf-8', buffering=CSV_BUFFER_SIZE)
+
+
 def prompt_user_for_account(id, name):
     """
     Prompts a user for input and returns the value.
@@ -187,41 +310,135 @@ def prompt_user_for_account(id, name):
     return input(f"Please enter the account number for '{name}' aka ID {id}: ")
 
 
-def write_billing_csv(data, user_filename):
+def read_csv(fp, headers):
+    """
+    Reads an open CSV file one line at a time and yields each line as a tuple
+    with the fields in the order of `headers`.
+    """
+    line_count = 0
+    csv_reader = split_csv_lines(fp)
+
+    # An empty file, such as a newly created mapping file, has no headers.
+    header_row = next(csv_reader, None)
+    if header_row is None:
+        LOGGER.info(f"No data in {fp.name}")
+        return
+
+    # Find where each expected header is in this file.
+    missing_headers = [field for field in headers if field not in header_row]
+    if missing_headers:
+        raise ValueError(f"Missing headers in {fp.name}: {missing_headers}")
+    to_headers_order = itemgetter(*[header_row.index(field) for field in headers])
+    intern_indexes = [header_row.index(field) for field in headers if field in INTERNED_FIELDS]
+    intern = sys.intern
+    header_count = len(header_row)
+
+    for row in csv_reader:
+        # Skip blank lines, the same as `csv.DictReader` does.
+        if not row:
+            continue
+        line_count += 1
+        # Missing trailing fields are empty, the same as `csv.DictReader` does.
+        if len(row) < header_count:
+            row.extend([''] * (header_count - len(row)))
+        for index in intern_indexes:
+            row[index] = intern(row[index])
+        yield to_headers_order(row)
+    LOGGER.info(f"Processed {line_count} lines from {fp.name}")
+
+
+def split_csv_lines(fp):
+    """
+    Splits the lines of a CSV file into lists of fields. Lines are split with
+    `str.split()` until a line contains a quote, then the rest of the file is
+    parsed by `csv.reader()` as quoted fields can contain delimiters and line
+    breaks.
+    """
+    for line in fp:
+        if '"' in line:
+            break
+        line = line.rstrip('\r\n')
+        # Blank lines are an empty list, the same as `csv.reader()`.
+        yield line.split(',') if line else []
+    else:
+        return
+
+    # Quoting and line terminators are detected by the reader, so only the
+    #   delimiter is set.
+    yield from csv.reader(chain([line], fp), delimiter=',')
+
+
+def write_billing_csv(data, user_filename, timestamp=None):
     """
     This is a wrapper to the `write_csv()` function to calculate a filename with
-    a timestamp.
+    a timestamp. The timestamp is a `time.struct_time` and defaults to the
+    current local time, passing one lets several files share the same name
+    timestamp. Returns the number of bytes written.
     """
 
     # If a filename that is not the default, use that value. Otherwise calculate
     #   the filename.
     if user_filename == DEFAULT_DEST_CSV_FILENAME:
-        DEFAULT_DEST_CSV_FILENAME_PREFIX
-        timestamp = datetime.datetime.now()
-        timestamp_string = timestamp.strftime("%Y%m%d_%H%M")
+        if timestamp is None:
+            timestamp = localtime()
+        timestamp_string = strftime("%Y%m%d_%H%M", timestamp)
         filename = f"{DEFAULT_DEST_CSV_FILENAME_PREFIX}{timestamp_string}.csv"
     else:
         filename = user_filename
 
-    write_csv(filename, BILLING_HEADERS, data)
+    size = write_csv(filename, BILLING_HEADERS, data)
+    LOGGER.info(f"Wrote {size} bytes to {filename}")
+
+    return size
 
 
 def write_csv(filename, headers, dataset):
     """
-    Writes data to a CSV file.
+    Writes data to a CSV file. Each row in the dataset must have its fields in
+    the order of `headers`. Files ending in `GZIP_SUFFIX` are compressed.
+    Returns the number of bytes written to disk, after any compression.
+
+    As the dataset may be converted while it is written, the data is written to
+    a partial file which only replaces `filename` once all of it is written.
     """
-    with open(filename, 'w') as fp:
-        wr = csv.DictWriter(
-            fp,
-            fieldnames=headers,
-            quoting=csv.QUOTE_ALL,
-            lineterminator='\r\n',
-            delimiter=','
-        )
-        wr.writeheader()
-        wr.writerows(dataset)
-
-    return True
+    partial_filename = f"{filename}{PARTIAL_SUFFIX}"
+
+    if filename.endswith(GZIP_SUFFIX):
+        # GzipFile leaves `raw_fp` open when it is closed, so the position of
+        #   `raw_fp` is then the compressed size. The gzip header is given the
+        #   final name rather than the name of the partial file.
+        raw_fp = open(partial_filename, 'wb', buffering=CSV_BUFFER_SIZE)
+        gzip_fp = gzip.GzipFile(filename=os.path.basename(filename), fileobj=raw_fp, mode='wb')
+        fp = io.TextIOWrapper(gzip_fp, newline='', encoding='utf-8')
+    else:
+        raw_fp = None
+        fp = open(partial_filename, 'w', newline='', encoding='utf-8', buffering=CSV_BUFFER_SIZE)
+
+    try:
+        with fp:
+            # Only quote fields that need it (delimiters, quotes or line breaks).
+            wr = csv.writer(
+                fp,
+                quoting=csv.QUOTE_MINIMAL,
+                lineterminator='\r\n',
+                delimiter=','
+            )
+            wr.writerow(headers)
+            wr.writerows(dataset)
+            size = fp.tell()
+        if raw_fp is not None:
+            size = raw_fp.tell()
+            raw_fp.close()
+    except BaseException:
+        # Includes the user interrupting a prompt, nothing is left behind.
+        if raw_fp is not None:
+            raw_fp.close()
+        os.remove(partial_filename)
+        raise
+
+    os.replace(partial_filename, filename)
+
+    return size
 
 ################################################################################
 #                                     Main                                     #
@@ -235,11 +452,11 @@ def parse_args():
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=ARGPARSE_DESCRIPTION)
     parser.add_argument('--source-csv-filename',
                         dest="source_csv_filename",
-                        help=f"CSV from water accounting system. Default: {DEFAULT_SOURCE_CSV_FILENAME}",
+                        help=f"CSV from water accounting system, may be gzip compressed ({GZIP_SUFFIX}). Default: {DEFAULT_SOURCE_CSV_FILENAME}",
                         default=DEFAULT_SOURCE_CSV_FILENAME)
     parser.add_argument('--dest-csv-filename',
                         dest="dest_csv_filename",
-                        help=f"CSV for the billing system. The default output is f{DEFAULT_DEST_CSV_FILENAME_PREFIX}_YYYYMMDD_HHMM.csv",
+                        help=f"CSV for the billing system, compressed with gzip if it ends in {GZIP_SUFFIX}. The default output is f{DEFAULT_DEST_CSV_FILENAME_PREFIX}_YYYYMMDD_HHMM.csv",
                         default=DEFAULT_DEST_CSV_FILENAME)
     parser.add_argument('-v',
                         dest="warn_logging",
@@ -280,30 +497,34 @@ if __name__ == "__main__":
     CH.setFormatter(FORMATTER)
     LOGGER.addHandler(CH)
 
-    LOGGER.info(f"Loading water accounting data from: {args.source_csv_filename}")
-    LOGGER.debug(f"Expecting water accounting data headers: {SOURCE_HEADERS}")
-    this_months_data = load_csv(args.source_csv_filename, SOURCE_HEADERS)
-
-    LOGGER.debug("Data from water accounting:")
-    LOGGER.debug(json.dumps(this_months_data, indent=4))
-
-    # Create mapping file if missing.
-    if exists(DEFAULT_MAPPING_CSV_FILENAME) == False:
-        LOGGER.error(f"Mapping file is missing, creating.")
-        Path(DEFAULT_MAPPING_CSV_FILENAME).touch()
-
-    # Load account mapping from CSV.
-    LOGGER.info(f"Loading account mapping data from: {DEFAULT_MAPPING_CSV_FILENAME}")
-    LOGGER.debug(f"Expecting account mapping headers: {MAPPING_HEADERS}")
-    account_mapping = load_csv(DEFAULT_MAPPING_CSV_FILENAME, MAPPING_HEADERS, load_as_dict=True)
-
-    LOGGER.debug("Data from account mapping:")
-    LOGGER.debug(json.dumps(account_mapping, indent=4))
-
-    # Process the water accounting CSV to the billing CSV.
-    LOGGER.info("Converting CSV to destination format.")
-    processed_data = convert_formats(this_months_data, account_mapping)
-
-    # Write the billing data to a timestamped CSV.
-    LOGGER.info("Writing converted data to CSV.")
-    write_billing_csv(processed_data, args.dest_csv_filename)
+    # The mapping file is opened once, the same file handle is used to load the
+    #   account mapping and to add new accounts to it.
+    with open_csv(args.source_csv_filename) as source_fp, open_mapping_csv(DEFAULT_MAPPING_CSV_FILENAME) as mapping_fp:
+        LOGGER.info(f"Loading water accounting data from: {args.source_csv_filename}")
+        LOGGER.debug(f"Expecting water accounting data headers: {SOURCE_HEADERS}")
+        this_months_data = load_csv(source_fp, SOURCE_HEADERS)
+
+        # The data is only read into memory when it needs to be logged, otherwise
+        #   it is read a line at a time while the billing CSV is written.
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            this_months_data = list(this_months_data)
+            LOGGER.debug("Data from water accounting:")
+            LOGGER.debug(json.dumps(this_months_data, indent=4))
+
+        # Load account mapping from CSV.
+        LOGGER.info(f"Loading account mapping data from: {DEFAULT_MAPPING_CSV_FILENAME}")
+        LOGGER.debug(f"Expecting account mapping headers: {MAPPING_HEADERS}")
+        account_mapping = load_csv(mapping_fp, MAPPING_HEADERS, load_as_dict=True)
+
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug("Data from account mapping:")
+            LOGGER.debug(json.dumps(account_mapping, indent=4))
+
+        # Process the water accounting CSV to the billing CSV. The conversion is
+        #   closed before the mapping file so new accounts are always saved.
+        LOGGER.info("Converting CSV to destination format.")
+        with closing(convert_formats(this_months_data, account_mapping, mapping_fp)) as processed_data:
+
+            # Write the billing data to a timestamped CSV.
+            LOGGER.info("Writing converted data to CSV.")
+            write_billing_csv(processed_data, args.dest_csv_filename)